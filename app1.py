@@ -1,12 +1,20 @@
-from flask import Flask, render_template, request, send_file, session, redirect, url_for, flash
+from quart import Quart, render_template, request, send_file, session, redirect, url_for, flash, g, Response
+import asyncio
 import sqlite3
+import io
 import os
-import tempfile
+import secrets
 import re
+import json
+import hashlib
+from diskcache import Cache
+from cachetools import TTLCache
+from jinja2 import FileSystemBytecodeCache
 from docx import Document
 from docx.shared import Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
 
 from dotenv import load_dotenv
 
@@ -19,25 +27,190 @@ APP_SECRET = os.getenv("FLASK_SECRET", "dev-secret")
 HIDE_VSP_FROM_DOCX = False          # Hide VSP in Word export
 VSP_VISIBLE_IN_UI = True           # Show VSP in result page
 OPENAI_MODEL = "gpt-4o"
+# The VSP is an internal intermediate that the exec call rewrites anyway, so
+# it goes to the cheaper/faster model; override via env to A/B.
+OPENAI_MODEL_DRAFT = os.getenv("OPENAI_MODEL_DRAFT", "gpt-4o-mini")
 TEMPERATURE_VSP = 0.9
 MAX_TOKENS_VSP = 1700
 TEMPERATURE_EXEC = 0.9
 MAX_TOKENS_EXEC = 1700
+MAX_TOKENS_FUSED = 3400
+LLM_CACHE_PATH = "./llm_cache"
+LLM_CACHE_TTL = 3600               # seconds; re-runs within the hour hit the cache
 
-# ----------------- Flask -----------------
-app = Flask(__name__)
+# ----------------- Quart -----------------
+# ASGI app: every await on an OpenAI call yields the worker to other requests,
+# so one uvicorn/hypercorn worker can hold many generations in flight instead
+# of one per thread under WSGI.
+app = Quart(__name__)
 app.secret_key = APP_SECRET
 
+# Compiled templates persist in a bytecode cache shared across workers and
+# restarts, and the per-render stat() for auto-reload is skipped; templates
+# only change with a deploy.
+_JINJA_CACHE_DIR = "/tmp/jinja_cache"
+os.makedirs(_JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(_JINJA_CACHE_DIR)
+app.jinja_env.auto_reload = False
+
 # ----------------- OpenAI -----------------
-client = OpenAI(
+# Single shared async client so concurrent requests overlap their network I/O
+# instead of serializing on one blocking connection. The SDK's default httpx
+# client throttles under many in-flight requests, so pass our own transport
+# with raised connection limits, HTTP/2, and transport-level retries.
+# limits must go into the transport: httpx ignores the client-level limits=
+# kwarg when an explicit transport= is supplied.
+http_client = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        retries=2, http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100)
+    ),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+client = AsyncOpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
-    organization=os.getenv("OPENAI_ORG_ID")
+    organization=os.getenv("OPENAI_ORG_ID"),
+    http_client=http_client
 )
 
-# ----------------- In-memory storage -----------------
+# ----------------- Response cache -----------------
+# Exact-match cache keyed on the full request (model, messages, temperature,
+# max tokens). With TEMPERATURE_VSP/EXEC at 0.9 responses are not deterministic,
+# so this is a best-effort replay for identical re-submissions (demos, retries,
+# double-clicks) rather than a semantic cache.
+llm_cache = Cache(LLM_CACHE_PATH)
+
+def _chat_cache_key(model, messages, temperature, max_tokens):
+    return hashlib.sha256(json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature,
+         "max_tokens": max_tokens},
+        sort_keys=True).encode()).hexdigest()
+
+async def cached_chat(messages, temperature, max_completion_tokens, model=OPENAI_MODEL):
+    key = _chat_cache_key(model, messages, temperature, max_completion_tokens)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        return cached
+    resp = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_completion_tokens=max_completion_tokens
+    )
+    text = resp.choices[0].message.content.strip()
+    llm_cache.set(key, text, expire=LLM_CACHE_TTL)
+    return text
+
+async def stream_chat(messages, temperature, max_completion_tokens, model=OPENAI_MODEL):
+    # Streaming twin of cached_chat: yields text deltas as they arrive and
+    # fills the cache once the stream is done (a hit replays in one chunk).
+    key = _chat_cache_key(model, messages, temperature, max_completion_tokens)
+    cached = llm_cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_completion_tokens=max_completion_tokens,
+        stream=True
+    )
+    parts = []
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
+    llm_cache.set(key, "".join(parts).strip(), expire=LLM_CACHE_TTL)
+
+# ----------------- Session storage -----------------
+# Proposal state must survive landing on a different gunicorn worker, so it
+# lives in Redis whenever REDIS_URL is set; the process-local dict remains as
+# a single-worker fallback for local development.
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_TTL = 3600
+# Batch sessions must outlive the 24h completion window plus harvest slack,
+# or the poller finds the session expired and the paid-for output is dropped.
+BATCH_SESSION_TTL = 48 * 3600
+
+if REDIS_URL:
+    import redis
+    from rq import Queue
+    redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    # Generation jobs run in rq workers ('rq worker proposals'), so the web
+    # tier only enqueues and redirects instead of holding the request open.
+    task_queue = Queue("proposals", connection=redis.Redis.from_url(REDIS_URL))
+else:
+    redis_client = None
+    task_queue = None
+
 storage = {}
 
+def save_session(session_id, data, ttl=SESSION_TTL):
+    if redis_client:
+        redis_client.hset(f"sess:{session_id}", mapping=data)
+        redis_client.expire(f"sess:{session_id}", ttl)
+    else:
+        storage[session_id] = dict(data)
+
+def load_session(session_id):
+    if not session_id:
+        return None
+    if redis_client:
+        return redis_client.hgetall(f"sess:{session_id}") or None
+    return storage.get(session_id)
+
+def update_session(session_id, **fields):
+    if redis_client:
+        redis_client.hset(f"sess:{session_id}", mapping=fields)
+        # gt=True keeps whichever TTL is longer: renews live sessions
+        # without shortening long-lived batch sessions.
+        redis_client.expire(f"sess:{session_id}", SESSION_TTL, gt=True)
+    elif session_id in storage:
+        storage[session_id].update(fields)
+
+def drop_session(session_id):
+    if redis_client:
+        redis_client.delete(f"sess:{session_id}")
+    else:
+        storage.pop(session_id, None)
+
+# Double-submit guard: a hash of the normalized form payload maps to the
+# session it already produced, so browser retries and double-clicks within
+# the window reuse that session instead of paying for a fresh generation.
+SUBMIT_DEDUP_TTL = 600
+_submit_cache = TTLCache(maxsize=1024, ttl=SUBMIT_DEDUP_TTL)
+
+def get_recent_submission(body_hash):
+    if redis_client:
+        return redis_client.get(f"submit:{body_hash}")
+    return _submit_cache.get(body_hash)
+
+def remember_submission(body_hash, session_id):
+    if redis_client:
+        redis_client.set(f"submit:{body_hash}", session_id, ex=SUBMIT_DEDUP_TTL)
+    else:
+        _submit_cache[body_hash] = session_id
+
 # ----------------- DB Helpers -----------------
+# One connection per request (on flask.g) instead of connect/close per query.
+# WAL lets concurrent readers run alongside a writer; the busy timeout keeps
+# parallel gunicorn workers from failing fast on a locked database.
+def get_db():
+    if "db" not in g:
+        g.db = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+        g.db.execute("PRAGMA journal_mode=WAL")
+        g.db.execute("PRAGMA synchronous=NORMAL")
+        g.db.execute("PRAGMA busy_timeout=30000")
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exc):
+    db = g.pop("db", None)
+    if db is not None:
+        db.close()
+
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
@@ -54,67 +227,173 @@ def init_db():
             notes TEXT
         )
     """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_companies_name ON companies(name COLLATE NOCASE)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL,
+            output_file_id TEXT
+        )
+    """)
     conn.commit()
     conn.close()
 
+@app.before_serving
+async def ensure_schema():
+    # Schema setup must also run on the ASGI path (uvicorn app1:app), not
+    # just the __main__ runner, or the batches table and name index are
+    # missing on a fresh database.
+    init_db()
+
+# Company profiles only change through /setup, so the hot-path lookups
+# (every POST to / and every result render) are served from a small TTL
+# cache; inserts invalidate it.
+_COMPANY_CACHE = TTLCache(maxsize=256, ttl=300)
+
 def insert_company(profile):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cur = conn.cursor()
     cur.execute(
-        """INSERT INTO companies 
-        (name, industry, services, differentiators, contact_email, contact_phone, website, notes) 
+        """INSERT INTO companies
+        (name, industry, services, differentiators, contact_email, contact_phone, website, notes)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
         (profile.get("name"), profile.get("industry"), profile.get("services"),
          profile.get("differentiators"), profile.get("contact_email"), profile.get("contact_phone"),
          profile.get("website"), profile.get("notes"))
     )
     conn.commit()
-    company_id = cur.lastrowid
-    conn.close()
-    return company_id
+    _COMPANY_CACHE.pop("all", None)
+    return cur.lastrowid
 
 def get_companies():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, industry FROM companies ORDER BY name")
+    rows = _COMPANY_CACHE.get("all")
+    if rows is not None:
+        return rows
+    cur = get_db().cursor()
+    cur.execute("SELECT id, name, industry FROM companies ORDER BY name COLLATE NOCASE")
     rows = cur.fetchall()
-    conn.close()
+    _COMPANY_CACHE["all"] = rows
     return rows
 
 def get_company(company_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""SELECT id, name, industry, services, differentiators, contact_email, 
-                   contact_phone, website, notes 
+    company = _COMPANY_CACHE.get(company_id)
+    if company is not None:
+        return company
+    cur = get_db().cursor()
+    cur.execute("""SELECT id, name, industry, services, differentiators, contact_email,
+                   contact_phone, website, notes
                    FROM companies WHERE id = ?""", (company_id,))
     row = cur.fetchone()
-    conn.close()
     if not row:
         return None
-    keys = ["id", "name", "industry", "services", "differentiators", 
+    keys = ["id", "name", "industry", "services", "differentiators",
             "contact_email", "contact_phone", "website", "notes"]
-    return dict(zip(keys, row))
+    company = dict(zip(keys, row))
+    _COMPANY_CACHE[company_id] = company
+    return company
+
+def insert_batch(batch_id, session_id, kind):
+    conn = get_db()
+    conn.execute("INSERT INTO batches (batch_id, session_id, kind, status) VALUES (?, ?, ?, ?)",
+                 (batch_id, session_id, kind, "submitted"))
+    conn.commit()
+
+def get_pending_batches():
+    cur = get_db().cursor()
+    cur.execute("SELECT id, batch_id, session_id, kind FROM batches WHERE status = 'submitted'")
+    return cur.fetchall()
+
+def update_batch(row_id, status, output_file_id=None):
+    conn = get_db()
+    conn.execute("UPDATE batches SET status = ?, output_file_id = ? WHERE id = ?",
+                 (status, output_file_id, row_id))
+    conn.commit()
 
 # ----------------- Text cleaning -----------------
+# Compiled once at import; clean_text_block runs on every model response.
+_RE_BOLD = re.compile(r"\*\*(.*?)\*\*")
+_RE_ITALIC = re.compile(r"\*(.*?)\*")
+_RE_HEADING = re.compile(r"^#+\s*", re.MULTILINE)
+_RE_BULLET = re.compile(r"•\s*", re.MULTILINE)
+_RE_BLANKS = re.compile(r"\n{3,}")
+
 def clean_text_block(text: str) -> str:
     if not text:
         return ""
     text = str(text)
-    text = re.sub(r"\*\*(.*?)\*\*", r"\1", text)
-    text = re.sub(r"\*(.*?)\*", r"\1", text)
-    text = re.sub(r"^#+\s*", "", text, flags=re.MULTILINE)
-    text = re.sub(r"•\s*", "- ", text, flags=re.MULTILINE)
-    text = re.sub(r"\r\n", "\n", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    text = _RE_BOLD.sub(r"\1", text)
+    text = _RE_ITALIC.sub(r"\1", text)
+    text = _RE_HEADING.sub("", text)
+    text = _RE_BULLET.sub("- ", text)
+    text = text.replace("\r\n", "\n")
+    text = _RE_BLANKS.sub("\n\n", text)
     return text.strip()
 
+# ----------------- DOCX heading detection -----------------
+# Prefix → title tables for the download handler, so each line is classified
+# with one C-level startswith(tuple) instead of a chain of comparisons.
+# "{provider}" is filled in with the company name at write time.
+EXEC_HEADINGS = (
+    ("introduction", "Introduction"),
+    ("our understanding", "Our Understanding of Your Goals"),
+    ("our approach", "Our Approach to Meeting Your Goals"),
+    ("solution overview", "Solution Overview"),
+    ("how we will deliver", "How We Will Deliver"),
+    ("why", "Why {provider}"),
+    ("closing", "Closing Call-to-Action"),
+)
+EXEC_HEADING_PREFIXES = tuple(p for p, _ in EXEC_HEADINGS)
+
+VSP_HEADINGS = (
+    ("case for change", "Case for Change"),
+    ("business value", "Business Value for the Client"),
+    ("proposed solution", "{provider} Proposed Solution"),
+)
+VSP_HEADING_PREFIXES = tuple(p for p, _ in VSP_HEADINGS)
+
+_RE_CLOSING = re.compile(r"\n?7\)\s*Closing.*|^Closing.*", re.IGNORECASE | re.DOTALL)
+
+def render_section(doc, text, headings, prefixes, provider_name,
+                   body_align=WD_ALIGN_PARAGRAPH.JUSTIFY, body_space=8):
+    # Shared writer for the exec, VSP, and client-context blocks: classifies
+    # each line as heading / bullet / body paragraph and styles it.
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if not stripped:
+            continue
+        lower = stripped.lower()
+        if prefixes and lower.startswith(prefixes):
+            title = next(t for p, t in headings
+                         if lower.startswith(p)).format(provider=provider_name)
+            para = doc.add_paragraph(title)
+            run = para.runs[0]
+            run.bold = True
+            run.font.size = Pt(14)
+            para.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
+            para.paragraph_format.space_after = Pt(10)
+        elif stripped.startswith("- "):
+            para = doc.add_paragraph(stripped[2:], style="List Bullet")
+            para.paragraph_format.space_after = Pt(4)
+        else:
+            para = doc.add_paragraph(stripped)
+            para.paragraph_format.alignment = body_align
+            para.paragraph_format.space_after = Pt(body_space)
+
 # ----------------- Prompts -----------------
+# Static instructions live in constant system messages; the per-request inputs
+# go in a short user message at the end. Keeping the long instruction block
+# byte-identical across requests lets OpenAI's automatic prompt caching reuse
+# the shared prefix (the provider name is supplied in the inputs and referenced
+# as <Provider> in the instructions).
 
-# Single-pass Executive Summary prompt, with stronger rules only for:
+# Single-pass Executive Summary instructions, with stronger rules only for:
 # - Solution Overview
 # - How We Will Deliver
-# - Why {provider_name}
-EXEC_PROMPT_TEMPLATE = """
+# - Why <Provider>
+EXEC_SYSTEM_STATIC = """
 You are a senior management consultant. Using the provider profile and the VSP, produce a polished,
 client-ready Executive Summary in well formatted plain text (no Markdown, no ##, no **).
 Tone must mirror the business-driven, persuasive style of the VSP — sharp, opportunity-focused, and executive-level.
@@ -127,8 +406,9 @@ Requirements:
   3) Our Approach to Meeting Your Goals
   4) Solution Overview
   5) How We Will Deliver
-  6) Why {provider_name}
+  6) Why <Provider>
   7) Closing Call-to-Action
+- Wherever <Provider> appears, substitute the Provider Name given in the inputs.
 - Headings must appear exactly once and in order. Do not repeat any heading.
 - After “Our Understanding of Your Goals”, maintain forward flow: Approach → Solution → Delivery → Why.
 - Frame the client positively (readiness/opportunity). Avoid weakness/problem language.
@@ -154,15 +434,20 @@ Section specifics:
 - How We Will Deliver:
   - 3–5 bullets. Focus on execution mechanics: governance cadence, risk mitigation, phased rollout, joint ownership/BOT, enablement/training.
   - Tie each bullet to measurement and confidence (baselines, KPIs, ranges ok).
-- Why {provider_name}:
+- Why <Provider>:
   - 3–5 bullets. Reuse differentiators from provider profile and VSP (e.g., certifications, domain expertise, security-first, references).
   - Each bullet must explicitly state the client value of that differentiator.
 
 - Closing Call-to-Action:
   - 2–3 sentences. Formal, decisive, non-casual.
   - Invite next-step meeting (e.g., governance/kickoff/strategy session) AND include the provider’s contact email and phone from the provider profile if present.
+"""
 
+
+def get_exec_user_message(provider_name, provider_profile, vsp_resp, website, client_context):
+    return f"""
 Inputs:
+- Provider Name: {provider_name}
 - PROVIDER_PROFILE:
 {provider_profile}
 - VSP:
@@ -174,25 +459,30 @@ Inputs:
 """
 
 
-
-def get_vsp_prompt(company, provider_profile_text, client_context):
-    return f"""
+VSP_SYSTEM_STATIC = """
 You are a senior management consultant. Based on the provider profile and client context,
 generate a Value Selling Points (VSP) document.
 
 Guidelines:
 - Plain text only (no Markdown, no symbols).
 - Each bullet must be a strong business phrase (1–2 lines).
+- Wherever <Provider> appears, substitute the Provider Name given in the inputs.
 - Structure exactly:
 
 Case for Change
 - ...
 Business Value for the Client
 - ...
-{company['name']} Proposed Solution
+<Provider> Proposed Solution
 - ...
+"""
+
 
+def get_vsp_user_message(provider_name, provider_profile_text, client_context):
+    return f"""
 Inputs:
+Provider Name: {provider_name}
+
 PROVIDER_PROFILE:
 {provider_profile_text}
 
@@ -200,71 +490,195 @@ CLIENT_CONTEXT:
 {client_context}
 """
 
+
+# Fused variant: one call produces both documents as structured JSON, so the
+# shared inputs (provider profile, client context) are billed once and the
+# VSP→exec round trip disappears. Used where nobody is watching tokens arrive;
+# the live /stream path keeps two calls so each pane streams independently.
+FUSED_SYSTEM_STATIC = f"""
+Produce BOTH documents described below from the same inputs and return them as
+JSON with keys "vsp" and "executive_summary".
+
+"vsp" — follow these instructions:
+{VSP_SYSTEM_STATIC}
+
+"executive_summary" — follow these instructions, treating the VSP you just
+wrote as the VSP input and reusing its exact phrases where required:
+{EXEC_SYSTEM_STATIC}
+"""
+
+FUSED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "proposal_documents",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "vsp": {"type": "string"},
+                "executive_summary": {"type": "string"}
+            },
+            "required": ["vsp", "executive_summary"],
+            "additionalProperties": False
+        }
+    }
+}
+
+
+def get_fused_user_message(provider_name, provider_profile_text, website, client_context):
+    return f"""
+Inputs:
+- Provider Name: {provider_name}
+- PROVIDER_PROFILE:
+{provider_profile_text}
+- Website of provider:
+{website}
+- CLIENT_CONTEXT:
+{client_context}
+"""
+
+
+def parse_fused_response(content):
+    payload = json.loads(content)
+    return (clean_text_block(payload["vsp"].strip()),
+            clean_text_block(payload["executive_summary"].strip()))
+
+
+REFINE_SYSTEM_STATIC = """
+You are a professional consultant refining executive summaries.
+Refine the Executive Summary given in the inputs using the refine instructions exactly.
+
+Rules:
+- Keep section order intact (Introduction → … → Closing Call-to-Action).
+- Reuse VSP phrases in Solution Overview, How We Will Deliver, and Why <Provider>.
+- Wherever <Provider> appears, substitute the Provider Name given in the inputs.
+- Use "-" for bullets where bullets already exist.
+- Do NOT add Markdown or placeholders.
+- Preserve the existing Closing Call-to-Action format and contact details.
+"""
+
+
+def get_refine_user_message(provider_name, refine_input, draft):
+    return f"""
+Inputs:
+Provider Name: {provider_name}
+
+REFINE_INSTRUCTIONS:
+{refine_input}
+
+EXECUTIVE_SUMMARY:
+{draft}
+"""
+
+
+def build_provider_profile(company):
+    return (f"{company['name']} (Industry: {company['industry']}). Services: {company['services']}. "
+            f"Differentiators: {company['differentiators']}. Website: {company['website']}. "
+            f"Contact: {company['contact_email']} | {company['contact_phone']}.")
+
+# ----------------- Batch API (non-interactive generations) -----------------
+# Opt-in path for generations nobody is waiting on: requests are written as a
+# JSONL batch against /v1/chat/completions (half price, separate rate-limit
+# pool) and harvested later via /batch/poll. A session is one fused batch line
+# producing both documents as JSON.
+
+BATCH_COMPLETION_WINDOW = "24h"
+
+async def submit_batch(session_id, kind, messages, temperature, max_tokens, response_format=None):
+    body = {
+        "model": OPENAI_MODEL,
+        "messages": messages,
+        "temperature": temperature,
+        "max_completion_tokens": max_tokens
+    }
+    if response_format is not None:
+        body["response_format"] = response_format
+    line = {
+        "custom_id": f"{session_id}:{kind}",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": body
+    }
+    batch_file = await client.files.create(
+        file=("batch.jsonl", (json.dumps(line) + "\n").encode()),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window=BATCH_COMPLETION_WINDOW
+    )
+    insert_batch(batch.id, session_id, kind)
+    return batch.id
+
 # ----------------- Routes -----------------
 @app.route("/setup", methods=["GET", "POST"])
-def setup():
+async def setup():
     if request.method == "POST":
+        form = await request.form
         profile = {
-            "name": request.form.get("name", "").strip(),
-            "industry": request.form.get("industry", "").strip(),
-            "services": request.form.get("services", "").strip(),
-            "differentiators": request.form.get("differentiators", "").strip(),
-            "contact_email": request.form.get("contact_email", "").strip(),
-            "contact_phone": request.form.get("contact_phone", "").strip(),
-            "website": request.form.get("website", "").strip(),
-            "notes": request.form.get("notes", "").strip()
+            "name": form.get("name", "").strip(),
+            "industry": form.get("industry", "").strip(),
+            "services": form.get("services", "").strip(),
+            "differentiators": form.get("differentiators", "").strip(),
+            "contact_email": form.get("contact_email", "").strip(),
+            "contact_phone": form.get("contact_phone", "").strip(),
+            "website": form.get("website", "").strip(),
+            "notes": form.get("notes", "").strip()
         }
         if not profile["name"]:
-            flash("Company name is required", "warning")
-            return render_template("setup.html", profile=profile)
+            await flash("Company name is required", "warning")
+            return await render_template("setup.html", profile=profile)
         company_id = insert_company(profile)
-        flash(f"Company profile '{profile['name']}' created.", "success")
+        await flash(f"Company profile '{profile['name']}' created.", "success")
         return redirect(url_for("index", company_id=company_id))
-    return render_template("setup.html")
+    return await render_template("setup.html")
 
 @app.route("/", methods=["GET", "POST"])
-def index():
+async def index():
     companies = get_companies()
     default_company_id = request.args.get("company_id")
 
     if request.method == "POST":
+        form = await request.form
+
         # ---------- Mandatory field checks ----------
         errors = []
         try:
-            company_id = int(request.form.get("company_id"))
+            company_id = int(form.get("company_id"))
         except Exception:
             company_id = None
         if not company_id:
             errors.append("Please select a provider.")
 
-        client_name = request.form.get("client_name", "").strip()
+        client_name = form.get("client_name", "").strip()
         if not client_name:
             errors.append("Client Name is required.")
-        client_industry = request.form.get("client_industry", "").strip()
+        client_industry = form.get("client_industry", "").strip()
         if not client_industry:
             errors.append("Client Industry is required.")
-        client_goals = request.form.get("client_goals", "").strip()
+        client_goals = form.get("client_goals", "").strip()
         if not client_goals:
             errors.append("Client Goals / Challenges are required.")
-        proposal_modules = request.form.get("proposal_modules", "").strip()
+        proposal_modules = form.get("proposal_modules", "").strip()
         if not proposal_modules:
             errors.append("Proposed Solutions / Modules are required.")
-        recipient_role = request.form.get("recipient_role", "").strip()
+        recipient_role = form.get("recipient_role", "").strip()
         if not recipient_role:
          errors.append("Recipient Role is required.")
-        execution_model = request.form.get("execution_model", "").strip()
-        extra_notes = request.form.get("extra_notes", "").strip()
-        
+        execution_model = form.get("execution_model", "").strip()
+        extra_notes = form.get("extra_notes", "").strip()
+
 
         if errors:
             for e in errors:
-                flash(e, "warning")
-            return render_template("index.html", companies=companies, default_company_id=default_company_id)
+                await flash(e, "warning")
+            return await render_template("index.html", companies=companies, default_company_id=default_company_id)
 
         # ---------- Get company ----------
         company = get_company(company_id)
         if not company:
-            flash("Selected company not found.", "danger")
+            await flash("Selected company not found.", "danger")
             return redirect(url_for("setup"))
 
         # ---------- Build client context ----------
@@ -279,119 +693,97 @@ Additional Notes: {extra_notes}
 """.strip()
 
         # ---------- Prepare session ----------
-        session_id = os.urandom(8).hex()
-        session["id"] = session_id
-        storage[session_id] = {"client_context": client_context, "draft": "", "vsp": "", "company_id": company_id}
-
-        provider_profile_text = f"{company['name']} (Industry: {company['industry']}). Services: {company['services']}. Differentiators: {company['differentiators']}. Website: {company['website']}. Contact: {company['contact_email']} | {company['contact_phone']}."
-
-        # ---------- Generate VSP ----------
-        vsp_prompt = get_vsp_prompt(company, provider_profile_text, client_context)
-        try:
-            vsp_resp = client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[
-                    {"role": "system", "content": "You are an expert proposal writer."},
-                    {"role": "user", "content": vsp_prompt}
-                ],
-                temperature=TEMPERATURE_VSP,
-                max_completion_tokens=MAX_TOKENS_VSP
-            )
-            vsp_text = clean_text_block(vsp_resp.choices[0].message.content.strip())
-        except Exception as e:
-            vsp_text = f"VSP generation failed: {e}"
-
-        storage[session_id]["vsp"] = vsp_text
+        # ---------- Double-submit dedup ----------
+        body_hash = hashlib.sha256(json.dumps(
+            {"company_id": company_id, "client_context": client_context},
+            sort_keys=True).encode()).hexdigest()
+        existing = get_recent_submission(body_hash)
+        if existing and load_session(existing) is not None:
+            session["id"] = existing
+            return redirect(url_for("result"))
 
-        # ---------- Generate Executive Summary (single pass) ----------
-        exec_prompt = EXEC_PROMPT_TEMPLATE.format(
-            provider_profile=provider_profile_text,
-            client_context=client_context,
-            provider_name=company['name'],
-            website=company["website"],
-            vsp_resp=vsp_text
-        )
-
-        try:
-            exec_resp = client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=[
-                    {"role": "system", "content": "You are a senior management consultant writing client-ready executive summaries."},
-                    {"role": "user", "content": exec_prompt}
-                ],
-                temperature=TEMPERATURE_EXEC,
-                max_completion_tokens=MAX_TOKENS_EXEC
-            )
-            exec_text = clean_text_block(exec_resp.choices[0].message.content.strip())
-        except Exception as e:
-            exec_text = f"Executive Summary generation failed: {e}"
+        if form.get("batch_mode"):
+            mode = "batch"
+        elif task_queue:
+            mode = "queued"
+        else:
+            mode = "live"
+        session_id = secrets.token_urlsafe(16)
+        session["id"] = session_id
+        save_session(session_id, {"client_context": client_context, "draft": "", "vsp": "",
+                                  "company_id": company_id, "mode": mode},
+                     ttl=BATCH_SESSION_TTL if mode == "batch" else SESSION_TTL)
+        remember_submission(body_hash, session_id)
 
-        # ---------- Replace any model-written closing with formal CTA ----------
-        prov = company.get('name', 'Provider')
-        client_disp = client_name if client_name else "the client"
-        formal_cta = (
-            f"{prov} recommends moving forward with a phased engagement to realize measurable operational efficiencies within the first year. "
-            f"We are prepared to initiate governance reviews, align executive stakeholders, and formalize next steps to ensure {client_disp} achieves "
-            f"sustainable improvements in patient satisfaction, cost efficiency, and compliance readiness."
-        )
-        # Remove any existing closing section the model might have written
+        # ---------- Batch mode (opt-in, non-interactive) ----------
+        if mode == "batch":
+            provider_profile_text = build_provider_profile(company)
+            fused_user = get_fused_user_message(company['name'], provider_profile_text,
+                                                company["website"], client_context)
+            try:
+                await submit_batch(
+                    session_id, "fused",
+                    [
+                        {"role": "system", "content": FUSED_SYSTEM_STATIC},
+                        {"role": "user", "content": fused_user}
+                    ],
+                    TEMPERATURE_EXEC, MAX_TOKENS_FUSED,
+                    response_format=FUSED_RESPONSE_FORMAT
+                )
+                await flash("Batch submitted. Results will appear on this page once the batch completes.", "info")
+            except Exception as e:
+                await flash(f"Batch submission failed: {e}", "danger")
 
-        storage[session_id]["draft"] = exec_text
+        # ---------- Queued mode: hand the job to an rq worker ----------
+        elif mode == "queued":
+            task_queue.enqueue(run_generate_proposal, session_id)
 
+        # Live sessions generate on /stream once the result page opens, queued
+        # ones are polled via /status — either way the POST returns in
+        # milliseconds instead of blocking on 30-60s of completions.
         return redirect(url_for("result"))
 
     # ---------- GET request ----------
-    return render_template("index.html", companies=companies, default_company_id=default_company_id)
+    return await render_template("index.html", companies=companies, default_company_id=default_company_id)
 
 # ----------------- Result Route -----------------
 @app.route("/result", methods=["GET", "POST"])
-def result():
+async def result():
     session_id = session.get("id")
-    if not session_id or session_id not in storage:
-        flash("No active proposal found. Please generate one.", "warning")
+    data = load_session(session_id)
+    if data is None:
+        await flash("No active proposal found. Please generate one.", "warning")
         return redirect(url_for("index"))
 
-    data = storage[session_id]
     draft = data.get("draft", "")
     vsp = data.get("vsp", "")
     client_context = data.get("client_context", "")
     company_id = data.get("company_id")
-    company = get_company(company_id) if company_id else None
+    company = get_company(int(company_id)) if company_id else None
 
     if request.method == "POST":
+        form = await request.form
+
         # ---------- Refine ----------
-        if "refine" in request.form:
-            refine_input = request.form.get("refine_prompt", "").strip()
+        if "refine" in form:
+            refine_input = form.get("refine_prompt", "").strip()
             if not refine_input:
-                flash("Refine instructions cannot be empty.", "warning")
-                return render_template("result.html", draft=draft, vsp=vsp,
-                                       context=client_context, company=company, show_vsp=VSP_VISIBLE_IN_UI)
-
-            refine_prompt = f"""
-Refine the Executive Summary below using these instructions exactly:
-{refine_input}
-
-Executive Summary:
-{draft}
+                await flash("Refine instructions cannot be empty.", "warning")
+                return await render_template("result.html", draft=draft, vsp=vsp,
+                                             context=client_context, company=company, show_vsp=VSP_VISIBLE_IN_UI,
+                                             mode=data.get("mode", "live"))
 
-Rules:
-- Keep section order intact (Introduction → … → Closing Call-to-Action).
-- Reuse VSP phrases in Solution Overview, How We Will Deliver, and Why {company['name'] if company else 'Provider'}.
-- Use "-" for bullets where bullets already exist.
-- Do NOT add Markdown or placeholders.
-- Preserve the existing Closing Call-to-Action format and contact details.
-"""
+            refine_user = get_refine_user_message(
+                company['name'] if company else 'Provider', refine_input, draft)
             try:
-                refine_resp = client.chat.completions.create(
-                    model=OPENAI_MODEL,
-                    messages=[
-                        {"role": "system", "content": "You are a professional consultant refining executive summaries."},
-                        {"role": "user", "content": refine_prompt}
+                draft = clean_text_block(await cached_chat(
+                    [
+                        {"role": "system", "content": REFINE_SYSTEM_STATIC},
+                        {"role": "user", "content": refine_user}
                     ],
                     temperature=TEMPERATURE_EXEC,
                     max_completion_tokens=MAX_TOKENS_EXEC
-                )
-                draft = clean_text_block(refine_resp.choices[0].message.content.strip())
+                ))
 
                 # Re-append formal CTA to be safe
                 prov = company.get('name', 'Provider') if company else "Provider"
@@ -401,56 +793,19 @@ Rules:
                     f"We are prepared to initiate governance reviews, align executive stakeholders, and formalize next steps to ensure {client_disp} achieves "
                     f"sustainable improvements in patient satisfaction, cost efficiency, and compliance readiness."
                 )
-                draft = re.sub(r"\n?7\)\s*Closing.*|^Closing.*", "", draft, flags=re.IGNORECASE | re.DOTALL).strip()
+                draft = _RE_CLOSING.sub("", draft).strip()
                 draft += "\n\nClosing Call-to-Action\n" + formal_cta
 
-                storage[session_id]["draft"] = draft
+                update_session(session_id, draft=draft)
             except Exception as e:
-                flash(f"Refine failed: {e}", "danger")
+                await flash(f"Refine failed: {e}", "danger")
 
         # ---------- Download ----------
-        elif "download" in request.form:
+        elif "download" in form:
             doc = Document()
-            doc.add_heading(f"Executive Summary by {company['name'] if company else 'Provider'}", level=0)
-
-            # Write paragraphs with simple heading detection
-            for line in draft.split("\n"):
-                if not line.strip():
-                    continue
-                stripped = line.strip()
-                lower = stripped.lower()
-
-                if lower.startswith("introduction"):
-                    title = "Introduction"
-                elif lower.startswith("our understanding"):
-                    title = "Our Understanding of Your Goals"
-                elif lower.startswith("our approach"):
-                    title = "Our Approach to Meeting Your Goals"
-                elif lower.startswith("solution overview"):
-                    title = "Solution Overview"
-                elif lower.startswith("how we will deliver"):
-                    title = "How We Will Deliver"
-                elif lower.startswith("why"):
-                    title = f"Why {company['name'] if company else 'Provider'}"
-                elif lower.startswith("closing"):
-                    title = "Closing Call-to-Action"
-                else:
-                    title = None
-
-                if title:
-                    para = doc.add_paragraph(title)
-                    run = para.runs[0]
-                    run.bold = True
-                    run.font.size = Pt(14)
-                    para.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                    para.paragraph_format.space_after = Pt(10)
-                elif stripped.startswith("- "):
-                    para = doc.add_paragraph(stripped[2:], style="List Bullet")
-                    para.paragraph_format.space_after = Pt(4)
-                else:
-                    para = doc.add_paragraph(stripped)
-                    para.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                    para.paragraph_format.space_after = Pt(8)
+            provider_name = company['name'] if company else 'Provider'
+            doc.add_heading(f"Executive Summary by {provider_name}", level=0)
+            render_section(doc, draft, EXEC_HEADINGS, EXEC_HEADING_PREFIXES, provider_name)
 
             # Contact info
             doc.add_heading("Contact Information", level=1)
@@ -468,60 +823,233 @@ Rules:
             # Optional VSP appendix
             if not HIDE_VSP_FROM_DOCX and vsp.strip():
                 doc.add_page_break()
-                doc.add_heading(f"Value Selling Points by {company['name'] if company else 'Provider'}", level=0)
-                for line in vsp.split("\n"):
-                    if not line.strip():
-                        continue
-                    stripped = line.strip()
-                    lower = stripped.lower()
-                    if lower.startswith("case for change"):
-                        title = "Case for Change"
-                    elif lower.startswith("business value"):
-                        title = "Business Value for the Client"
-                    elif (company and lower.startswith(company['name'].lower())) or lower.startswith("proposed solution"):
-                        title = f"{company['name']} Proposed Solution" if company else "Proposed Solution"
-                    else:
-                        title = None
-
-                    if title:
-                        para = doc.add_paragraph(title)
-                        run = para.runs[0]
-                        run.bold = True
-                        run.font.size = Pt(14)
-                        para.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                        para.paragraph_format.space_after = Pt(10)
-                    elif stripped.startswith("- "):
-                        para = doc.add_paragraph(stripped[2:], style="List Bullet")
-                        para.paragraph_format.space_after = Pt(4)
-                    else:
-                        para = doc.add_paragraph(stripped)
-                        para.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                        para.paragraph_format.space_after = Pt(6)
-                
-                # -------- Client Context Section --------
+                doc.add_heading(f"Value Selling Points by {provider_name}", level=0)
+                vsp_headings = VSP_HEADINGS
+                vsp_prefixes = VSP_HEADING_PREFIXES
+                if company:
+                    # "Acme Proposed Solution" lines start with the provider name
+                    vsp_headings += ((company['name'].lower(), "{provider} Proposed Solution"),)
+                    vsp_prefixes += (company['name'].lower(),)
+                render_section(doc, vsp, vsp_headings, vsp_prefixes, provider_name, body_space=6)
+
+            # -------- Client Context Section --------
             if client_context:
-                 doc.add_page_break()
-                 doc.add_heading("Client Context", level=0)
-                 for line in client_context.split("\n"):
-                  if not line.strip():
-                   continue
-                  para = doc.add_paragraph(line.strip())
-                  para.paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                  para.paragraph_format.space_after = Pt(6)
-
-            tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".docx")
-            doc.save(tmp_file.name)
-            return send_file(tmp_file.name, as_attachment=True, download_name="Executive_Summary.docx")
+                doc.add_page_break()
+                doc.add_heading("Client Context", level=0)
+                render_section(doc, client_context, (), (), provider_name,
+                               body_align=WD_ALIGN_PARAGRAPH.LEFT, body_space=6)
+
+            buf = io.BytesIO()
+            doc.save(buf)
+            buf.seek(0)
+            return await send_file(
+                buf,
+                mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                as_attachment=True,
+                attachment_filename="Executive_Summary.docx"
+            )
 
         # ---------- Finish ----------
-        elif "finish" in request.form:
-            storage.pop(session_id, None)
+        elif "finish" in form:
+            drop_session(session_id)
             session.clear()
-            flash("Session cleared.", "info")
+            await flash("Session cleared.", "info")
             return redirect(url_for("index"))
 
-    return render_template("result.html", draft=draft, vsp=vsp,
-                           context=client_context, company=company, show_vsp=VSP_VISIBLE_IN_UI)
+    return await render_template("result.html", draft=draft, vsp=vsp,
+                                 context=client_context, company=company, show_vsp=VSP_VISIBLE_IN_UI,
+                                 mode=data.get("mode", "live"))
+
+# ----------------- Live token stream -----------------
+async def _stream_events(session_id, data, company):
+    try:
+        async for event in _generate_events(session_id, data, company):
+            yield event
+    finally:
+        # Clear the in-flight marker even on client disconnect, so a reload
+        # can restart an aborted generation.
+        update_session(session_id, generating="")
+
+async def _generate_events(session_id, data, company):
+    provider_profile_text = build_provider_profile(company)
+    client_context = data["client_context"]
+
+    vsp_user = get_vsp_user_message(company['name'], provider_profile_text, client_context)
+    vsp_parts = []
+    try:
+        async for delta in stream_chat(
+            [
+                {"role": "system", "content": VSP_SYSTEM_STATIC},
+                {"role": "user", "content": vsp_user}
+            ],
+            temperature=TEMPERATURE_VSP,
+            max_completion_tokens=MAX_TOKENS_VSP,
+            model=OPENAI_MODEL_DRAFT
+        ):
+            vsp_parts.append(delta)
+            yield f"event: vsp\ndata: {json.dumps(delta)}\n\n"
+        vsp_text = clean_text_block("".join(vsp_parts).strip())
+    except Exception as e:
+        vsp_text = f"VSP generation failed: {e}"
+        yield f"event: vsp\ndata: {json.dumps(vsp_text)}\n\n"
+    update_session(session_id, vsp=vsp_text)
+
+    exec_user = get_exec_user_message(
+        provider_name=company['name'],
+        provider_profile=provider_profile_text,
+        vsp_resp=vsp_text,
+        website=company["website"],
+        client_context=client_context
+    )
+    exec_parts = []
+    try:
+        async for delta in stream_chat(
+            [
+                {"role": "system", "content": EXEC_SYSTEM_STATIC},
+                {"role": "user", "content": exec_user}
+            ],
+            temperature=TEMPERATURE_EXEC,
+            max_completion_tokens=MAX_TOKENS_EXEC
+        ):
+            exec_parts.append(delta)
+            yield f"event: draft\ndata: {json.dumps(delta)}\n\n"
+        exec_text = clean_text_block("".join(exec_parts).strip())
+    except Exception as e:
+        exec_text = f"Executive Summary generation failed: {e}"
+        yield f"event: draft\ndata: {json.dumps(exec_text)}\n\n"
+    update_session(session_id, draft=exec_text)
+    yield "event: done\ndata: {}\n\n"
+
+@app.route("/stream")
+async def stream():
+    session_id = session.get("id")
+    data = load_session(session_id)
+    company = get_company(int(data["company_id"])) if data else None
+    if data is None or company is None or data.get("draft") or data.get("generating"):
+        # Already finished or already generating (second tab / mid-stream
+        # reload): don't start a duplicate paid generation.
+        resp = Response("event: done\ndata: {}\n\n", mimetype="text/event-stream")
+        resp.timeout = None
+        return resp
+    update_session(session_id, generating=1)
+    # Quart responses take async generators directly. Both generations
+    # together routinely exceed Quart's 60s RESPONSE_TIMEOUT, so disable it
+    # for this response or the stream is cancelled mid-generation.
+    resp = Response(_stream_events(session_id, data, company), mimetype="text/event-stream")
+    resp.timeout = None
+    return resp
+
+# ----------------- Queued generation -----------------
+async def generate_proposal(session_id):
+    # Worker-side twin of _stream_events: same two calls, no browser attached.
+    async with app.app_context():
+        data = load_session(session_id)
+        if data is None:
+            return
+        company = get_company(int(data["company_id"]))
+        if company is None:
+            return
+        client_context = data["client_context"]
+        provider_profile_text = build_provider_profile(company)
+
+        vsp_user = get_vsp_user_message(company['name'], provider_profile_text, client_context)
+        try:
+            vsp_text = clean_text_block(await cached_chat(
+                [
+                    {"role": "system", "content": VSP_SYSTEM_STATIC},
+                    {"role": "user", "content": vsp_user}
+                ],
+                temperature=TEMPERATURE_VSP,
+                max_completion_tokens=MAX_TOKENS_VSP,
+                model=OPENAI_MODEL_DRAFT
+            ))
+        except Exception as e:
+            vsp_text = f"VSP generation failed: {e}"
+        update_session(session_id, vsp=vsp_text)
+
+        exec_user = get_exec_user_message(
+            provider_name=company['name'],
+            provider_profile=provider_profile_text,
+            vsp_resp=vsp_text,
+            website=company["website"],
+            client_context=client_context
+        )
+        try:
+            exec_text = clean_text_block(await cached_chat(
+                [
+                    {"role": "system", "content": EXEC_SYSTEM_STATIC},
+                    {"role": "user", "content": exec_user}
+                ],
+                temperature=TEMPERATURE_EXEC,
+                max_completion_tokens=MAX_TOKENS_EXEC
+            ))
+        except Exception as e:
+            exec_text = f"Executive Summary generation failed: {e}"
+        update_session(session_id, draft=exec_text)
+
+def run_generate_proposal(session_id):
+    # rq entry point: workers are sync processes, so drive the coroutine here.
+    asyncio.run(generate_proposal(session_id))
+
+@app.route("/status")
+async def status():
+    data = load_session(session.get("id"))
+    if data is None:
+        return {"done": True, "vsp": "", "draft": ""}
+    return {"done": bool(data.get("draft")),
+            "vsp": data.get("vsp", ""),
+            "draft": data.get("draft", "")}
+
+# ----------------- Batch poller -----------------
+@app.route("/batch/poll")
+async def batch_poll():
+    # Hit from cron (or manually) until the session's draft appears.
+    harvested = 0
+    for row_id, batch_id, session_id, kind in get_pending_batches():
+        try:
+            batch = await client.batches.retrieve(batch_id)
+        except Exception:
+            continue
+        if batch.status in ("failed", "expired", "cancelled"):
+            update_batch(row_id, batch.status)
+            continue
+        if batch.status != "completed":
+            continue
+
+        output = await client.files.content(batch.output_file_id)
+        stored = False
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            result_line = json.loads(line)
+            if load_session(session_id) is None:
+                continue
+            # Failed requests come back with a null response and an error
+            # object; record the failure instead of blowing up the poll.
+            error = result_line.get("error")
+            response = result_line.get("response")
+            if error or not response:
+                update_session(session_id, draft=f"Batch generation failed: {error}")
+                stored = True
+                continue
+            content = response["body"]["choices"][0]["message"]["content"].strip()
+            if kind == "fused":
+                try:
+                    vsp_text, exec_text = parse_fused_response(content)
+                except Exception as e:
+                    vsp_text, exec_text = "", f"Batch generation failed: {e}"
+                update_session(session_id, vsp=vsp_text, draft=exec_text)
+            else:
+                update_session(session_id, draft=clean_text_block(content))
+            stored = True
+        if stored:
+            update_batch(row_id, "completed", batch.output_file_id)
+            harvested += 1
+        else:
+            # Session expired before harvest: keep the output_file_id on the
+            # row so the result is still recoverable, but don't claim success.
+            update_batch(row_id, "orphaned", batch.output_file_id)
+    return {"harvested": harvested, "pending": len(get_pending_batches())}
     # Build messages list for chat UI
     
 